@@ -2,9 +2,16 @@ import streamlit as st
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.compute as pc
 import requests
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
-from datetime import timedelta
 from functools import reduce
 
 st.set_page_config(layout="wide")
@@ -19,90 +26,154 @@ target_hashes = [
 ]
 download_dir = Path("data")
 download_dir.mkdir(parents=True, exist_ok=True)
+timestamp_format = "%d.%m.%Y %H:%M"
+# Suurendada, kui parsitud vahemälu failide sisu muutub
+cache_version = 2
+
+# Üks ühenduste puuliga sessioon kogu protsessi peale
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.2)))
+    return session
 
 # Andmete allalaadimine
+def _fetch(session, url, file_path):
+    tmp_path = file_path.with_suffix(".part")
+    try:
+        with session.get(url, timeout=10, stream=True) as response:
+            if response.status_code == 200:
+                response.raw.decode_content = True
+                with tmp_path.open("wb") as f:
+                    shutil.copyfileobj(response.raw, f)
+                tmp_path.replace(file_path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+
 def download_data():
+    missing = []
     for h in target_hashes:
         file_path = download_dir / f"{h}.csv"
         if not file_path.exists():
             url = f"https://decision.cs.taltech.ee/electricity/data/{h}.csv"
-            try:
-                response = requests.get(url)
-                if response.status_code == 200:
-                    file_path.write_bytes(response.content)
-            except Exception:
-                pass
+            missing.append((file_path, url))
+    if not missing:
+        return
+    session = get_session()
+    progress_bar = st.progress(0.0)
+    with ThreadPoolExecutor(max_workers=min(8, len(missing))) as executor:
+        futures = [executor.submit(_fetch, session, url, file_path) for file_path, url in missing]
+        for done, _ in enumerate(as_completed(futures)):
+            progress_bar.progress((done + 1) / len(futures))
+    progress_bar.empty()
 
 download_data()
 
 # 100 päeva leidmine
 def find_100_day_window(dates):
-    dates = sorted(list(set(dates)))
-    for i in range(len(dates) - 99):
-        window = dates[i:i+100]
-        expected = [window[0] + timedelta(days=j) for j in range(100)]
-        if window == expected:
-            return window
-    return None
+    arr = np.unique(np.asarray(dates, dtype='datetime64[D]'))
+    days = arr.view('i8')
+    # Kasvavate unikaalsete päevade puhul on 100 järjestikust päeva siis, kui vahe 99 sammu peale on 99
+    hits = np.flatnonzero(days[99:] - days[:-99] == 99)
+    if len(hits) == 0:
+        return None
+    return arr[hits[0]:hits[0]+100]
+
+# Vahemälu fail kehtib, kui see on praeguse versiooniga ega ole CSV-st vanem
+def _cache_path(h, suffix):
+    return download_dir / f"{h}.v{cache_version}{suffix}"
+
+def _is_fresh(cache_path, csv_path):
+    return cache_path.exists() and cache_path.stat().st_mtime >= csv_path.stat().st_mtime
+
+# Varasemate versioonide vahemälu failid kustutatakse
+def _remove_stale(h, suffix, keep):
+    for path in download_dir.glob(f"{h}*{suffix}"):
+        if path != keep:
+            path.unlink(missing_ok=True)
+
+# Ühe faili lugemine, parsitud tulemus salvestatakse parquet-failina
+def load_single_dataset(h):
+    csv_path = download_dir / f"{h}.csv"
+    parquet_path = _cache_path(h, ".parquet")
+    if _is_fresh(parquet_path, csv_path):
+        df = pd.read_parquet(parquet_path, engine='pyarrow')
+    else:
+        table = pv.read_csv(
+            csv_path,
+            read_options=pv.ReadOptions(skip_rows=5, column_names=['Periood', 'consumption']),
+            parse_options=pv.ParseOptions(delimiter=';'),
+            convert_options=pv.ConvertOptions(column_types={'Periood': pa.string(), 'consumption': pa.float32()}, decimal_point=',')
+        )
+        periood = pc.strptime(table['Periood'], format=timestamp_format, unit='s', error_is_null=True)
+        table = table.set_column(0, 'Periood', periood).filter(pc.is_valid(periood))
+        df = table.to_pandas()
+        tmp_path = parquet_path.with_suffix(".part")
+        df.to_parquet(tmp_path, compression='zstd', index=False)
+        tmp_path.replace(parquet_path)
+        _remove_stale(h, ".parquet", parquet_path)
+    df['date'] = df['Periood'].values.astype('datetime64[D]')
+    df['hour'] = df['Periood'].dt.hour
+    dates_path = _cache_path(h, ".dates.npy")
+    if not _is_fresh(dates_path, csv_path):
+        tmp_path = dates_path.with_suffix(".part")
+        with tmp_path.open("wb") as f:
+            np.save(f, np.unique(df['date'].values.astype('datetime64[D]')))
+        tmp_path.replace(dates_path)
+        _remove_stale(h, ".dates.npy", dates_path)
+    df = df.drop(columns='Periood')
+    return df.set_index('date', drop=False).rename_axis(None).sort_index(kind='stable')
+
+# Kõik failid loetakse üks kord ja jagatakse allolevate funktsioonide vahel.
+# Tulemust ei kopeerita, seega tabeleid ei tohi kohapeal muuta.
+@st.cache_resource
+def load_all_datasets():
+    return {h: load_single_dataset(h) for h in target_hashes[:10]}
 
 @st.cache_data
 def load_profiles_for_100_days():
-    h = target_hashes[0]
-    df = pd.read_csv(download_dir / f"{h}.csv", sep=';', skiprows=4)
-    df.columns = ['Periood', 'consumption']
-    df['Periood'] = pd.to_datetime(df['Periood'], dayfirst=True, errors='coerce')
-    df['consumption'] = df['consumption'].astype(str).str.replace(',', '.').astype(float)
-    df.dropna(subset=['Periood'], inplace=True)
-    df['date'] = df['Periood'].dt.date
-    df['hour'] = df['Periood'].dt.hour
-    pivot = df.pivot_table(index='date', columns='hour', values='consumption')
-    pivot = pivot.dropna()
+    df = load_all_datasets()[target_hashes[0]]
+    df = df[df['consumption'].notna()]
+    hours_per_day = df.groupby('date', sort=False, observed=True)['hour'].nunique()
+    df = df[df['date'].isin(hours_per_day.index[hours_per_day.values == 24])]
+    pivot = df.groupby(['date', 'hour'], observed=True)['consumption'].mean().unstack('hour')
     valid_window = find_100_day_window(pivot.index)
-    return pivot.loc[valid_window] if valid_window else None
+    return pivot.loc[valid_window] if valid_window is not None else None
+
+# Faili kuupäevad salvestatakse eraldi, et neid saaks lugeda ilma andmeid parsimata
+def load_dates(h):
+    dates_path = _cache_path(h, ".dates.npy")
+    if _is_fresh(dates_path, download_dir / f"{h}.csv"):
+        return np.load(dates_path)
+    return np.unique(load_all_datasets()[h]['date'].values.astype('datetime64[D]'))
 
 @st.cache_data
 def find_common_day():
-    all_dates = []
-    for h in target_hashes[:10]:
-        df = pd.read_csv(download_dir / f"{h}.csv", sep=';', skiprows=4)
-        df.columns = ['Periood', 'consumption']
-        df['Periood'] = pd.to_datetime(df['Periood'], dayfirst=True, errors='coerce')
-        df.dropna(subset=['Periood'], inplace=True)
-        df['date'] = df['Periood'].dt.date
-        all_dates.append(set(df['date']))
-    common_dates = sorted(reduce(lambda a, b: a & b, all_dates))
-    return common_dates[0] if common_dates else None
+    all_dates = [load_dates(h) for h in target_hashes[:10]]
+    common_dates = reduce(np.intersect1d, all_dates)
+    return common_dates[0].astype('datetime64[D]') if len(common_dates) else None
 
 @st.cache_data
 def load_day_data(common_day):
     data = {}
-    for h in target_hashes[:10]:
-        df = pd.read_csv(download_dir / f"{h}.csv", sep=';', skiprows=4)
-        df.columns = ['Periood', 'consumption']
-        df['Periood'] = pd.to_datetime(df['Periood'], dayfirst=True, errors='coerce')
-        df.dropna(subset=['Periood'], inplace=True)
-        df['consumption'] = df['consumption'].astype(str).str.replace(',', '.').astype(float)
-        df['date'] = df['Periood'].dt.date
-        df['hour'] = df['Periood'].dt.hour
-        df_day = df[df['date'] == common_day]
-        data[h[-4:]] = df_day
+    for h, df in load_all_datasets().items():
+        data[h[-4:]] = df.loc[[common_day]] if common_day in df.index else df.iloc[:0]
     return data
 
 @st.cache_data
 def prepare_violin_data():
     common_day = find_common_day()
-    if not common_day:
+    if common_day is None:
         return None, None
     data = load_day_data(common_day)
-    rows = []
-    for label, df in data.items():
-        for _, row in df.iterrows():
-            rows.append({
-                "Mõõtepunkt": label,
-                "Tund": row['hour'],
-                "kWh": row['consumption']
-            })
-    return pd.DataFrame(rows), common_day
+    violin_df = (
+        pd.concat(data, names=['Mõõtepunkt'])
+        .reset_index(level='Mõõtepunkt')
+        .reset_index(drop=True)
+        .rename(columns={'hour': 'Tund', 'consumption': 'kWh'})
+        .astype({'Mõõtepunkt': pd.CategoricalDtype(list(data))})
+    )[['Mõõtepunkt', 'Tund', 'kWh']]
+    return violin_df, common_day
 
 # Streamlit UI
 st.title("Elektritarbimise alternatiivsed visualiseeringud")
@@ -112,8 +183,7 @@ st.subheader("100 järjestikuse päeva päevaprofiilid")
 profiles = load_profiles_for_100_days()
 if profiles is not None:
     fig1, ax1 = plt.subplots(figsize=(12, 6))
-    for date, row in profiles.iterrows():
-        ax1.plot(range(24), row.values, alpha=0.2)
+    ax1.plot(range(24), profiles.to_numpy().T, alpha=0.2)
     ax1.set_title("100 päeva tarbimisprofiilid")
     ax1.set_xlabel("Tund")
     ax1.set_ylabel("kWh")